@@ -1,17 +1,42 @@
 #!/usr/bin/env python3
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
+import asyncio
+import shelve
 import sys
 import os
 
-from lxml import html
-import requests
+from lxml import etree, html
+import aiohttp
 
 
 HOST = 'https://www.poemhunter.com'
 DEFAULT_CONCURRENCY = 30
 
+# XPath expressions compiled once up front--dom.xpath(...) would re-parse the
+# expression string on every one of the thousands of pages visited.
+POEM_TITLES_XP = etree.XPath('//*[@class="poems"]/tbody/tr/td[2]/a')
+NEXT_PAGE_XP = etree.XPath('//*[@class="next"]/a')
+POEM_BODY_XP = etree.XPath('//div[contains(@class, "poem-content")]//p')
+LINE_BREAKS_XP = etree.XPath('br')
+TOP_POETS_XP = etree.XPath('/html/body/div/div[6]/div[2]/div/div/ol/li/a[2]')
+
+# Maps characters that can't appear in file names to a dash, so that titles
+# like 'Love/Hate' don't blow up _save_poem.
+FS_SAFE_TABLE = str.maketrans('/\\:', '---')
+
+# Drops the stray \r artifacts that poemhunter.com leaves in poem bodies.
+# Only \r: deleting \n too would glue together words that wrap across an
+# embedded newline within a line.
+CR_STRIP = str.maketrans('', '', '\r')
+
+# Parser options for building leaner DOMs: we only ever match elements by
+# class, so skip the id table, comments and whitespace-only text nodes.
+PARSER_OPTS = dict(
+        collect_ids=False, remove_blank_text=True, remove_comments=True,
+        huge_tree=False)
+PARSER = html.HTMLParser(**PARSER_OPTS)
+
 
 class PoemHunter(object):
     def __init__(self, poet, dest, concurrency, verbose=False):
@@ -19,7 +44,8 @@ class PoemHunter(object):
 
         poet -- A string of the full name of the poet.
         dest -- A valid path at which to save the poems.
-        concurrency -- An integer specifying how many threads should be used.
+        concurrency -- An integer specifying how many downloads may be in
+            flight at a time.
         verbose -- Print progress and erorr reports if True.
         """
         if not poet:
@@ -28,8 +54,7 @@ class PoemHunter(object):
             raise TypeError('dest is a required argument')
         self.poet = poet
         self.dest = dest
-        self.downloaded_poems = []
-        self._executor = ThreadPoolExecutor(concurrency)
+        self._concurrency = concurrency
         self._verbose = verbose
 
         if self.poet.lower() not in self.dest.lower():
@@ -37,170 +62,347 @@ class PoemHunter(object):
             if not os.path.exists(self.dest):
                 os.makedirs(self.dest)
 
-    def run(self):
-        """Conccurently fetches and saves all poems of self.poet."""
-        # Format poet name as used in the URL.
-        poem_url_base = HOST + '/' + self.poet.lower().replace(' ', '-') + '/poems/'
-        futures = {}
-        page_no = 1
-        while True:
-            # nth page URL format:
-            # https://www.poemhunter.com/poet-name/poems/page-n
-            try:
-                page = requests.get(poem_url_base + f'page-{page_no}')
-            except IOError:
-                if self._verbose:
-                    print('Error loading page')
-                break
-            if not page.content:
-                break
-
-            dom = html.fromstring(page.content)
-
-            poem_titles = dom.xpath('//*[@class="poems"]/tbody/tr/td[2]/a')
-            for title in poem_titles:
-                future = self._executor.submit(
-                        self.download_poem,
-                        title.text,
-                        HOST + title.attrib['href'])
-                futures[future] = title.text
-
-            next_page = dom.xpath('//*[@class="next"]/a')
-            if not next_page:
-                break
-            page_no += 1
-
-        for future in as_completed(futures.keys()):
-            if future.result():
-                title = futures[future]
-                if self._verbose:
+        # Seed with the poems already on disk (by their file-system-safe
+        # names) so a restarted scrape skips them without touching the
+        # network. The dot filter keeps the cache db out of the set.
+        self.downloaded_poems = {name for name in os.listdir(self.dest)
+                                 if not name.startswith('.')}
+
+        # Maps URLs to their ETag/Last-Modified validators and the parsed
+        # page content, so re-runs can revalidate with a conditional GET and
+        # skip the body of unchanged pages entirely.
+        self._cache = shelve.open(self.dest + '/.etag_cache')
+
+    async def run(self, session=None):
+        """Conccurently fetches and saves all poems of self.poet.
+
+        session -- an optional aiohttp session shared with other hunters; if
+            omitted, the hunter creates and owns one sized to its concurrency
+            setting.
+        """
+        if session is not None:
+            await self._run(session)
+        else:
+            connector = aiohttp.TCPConnector(limit=self._concurrency)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                await self._run(session)
+
+    async def _run(self, session):
+        # Format poet name as used in the URL. nth page URL format:
+        # https://www.poemhunter.com/poet-name/poems/page-n
+        # The page URL template is bound once so the loop only runs the
+        # C-level % formatting, not a fresh f-string concat per page.
+        page_url = (HOST + '/' + self.poet.lower().replace(' ', '-')
+                    + '/poems/page-%d').__mod__
+        try:
+            tasks = []
+            scheduled = set()
+            page_no = 1
+            index_task = asyncio.create_task(self._fetch_index(
+                    session, page_url(page_no)))
+            while True:
+                try:
+                    poem_titles, has_next = await index_task
+                except (aiohttp.ClientError, IOError):
+                    if self._verbose:
+                        print('Error loading page')
+                    break
+                if poem_titles is None:
+                    break
+                if has_next:
+                    # Prefetch the next index page while this page's poems
+                    # are being scheduled to hide its round trip.
+                    page_no += 1
+                    index_task = asyncio.create_task(self._fetch_index(
+                            session, page_url(page_no)))
+
+                # Local bindings for the per-title loop: LOAD_FAST beats
+                # LOAD_ATTR/LOAD_GLOBAL on every iteration.
+                create_task = asyncio.create_task
+                download = self.download_poem
+                downloaded = self.downloaded_poems
+                fs_safe = FS_SAFE_TABLE
+                host = HOST
+                for title, href in poem_titles:
+                    # The same title can show up on multiple index pages, so
+                    # don't even spawn tasks for ones already seen (in this
+                    # run or, via the on-disk names, in an earlier one).
+                    if title in scheduled or title.translate(fs_safe) in downloaded:
+                        continue
+                    scheduled.add(title)
+                    tasks.append(create_task(
+                            download(session, title, host + href)))
+
+                if not has_next:
+                    break
+
+            # download_poem reports its own title back, so no reverse task
+            # to title mapping is needed here.
+            for completed in asyncio.as_completed(tasks):
+                title = await completed
+                if title and self._verbose:
                     print(f'{self.poet} - {title} saved.')
+        finally:
+            self._cache.close()
+
+    async def _fetch_index(self, session, url):
+        """Fetches one page of the poet's poem index.
 
-    def download_poem(self, title, url):
+        Returns a ((title, href) list, has-next-page) tuple, or (None, False)
+        if the page was empty. Unchanged pages are answered from the cache
+        via a conditional GET.
+        """
+        cached = self._cache.get(url)
+        async with session.get(url, headers=_conditional_headers(cached)) as page:
+            if page.status == 304:
+                return cached['titles'], cached['has_next']
+            if page.status != 200:
+                # Don't parse (or worse, cache) an error page as an index.
+                return None, False
+            dom = await self._parse_page(page)
+            if dom is None:
+                return None, False
+            validators = _validators(page)
+
+        # An anchor without text (e.g. one wrapping an image) has no title
+        # to dedupe or save under, so leave it out of the list and cache.
+        titles = [(a.text, a.attrib['href']) for a in POEM_TITLES_XP(dom)
+                  if a.text is not None]
+        has_next = bool(NEXT_PAGE_XP(dom))
+        if validators:
+            self._cache[url] = dict(
+                    titles=titles, has_next=has_next, **validators)
+        return titles, has_next
+
+    async def download_poem(self, session, title, url):
         """Fetches poem from poemhunter.com and saves it.
 
+        session -- the aiohttp session through which to download
         title -- title of the poem
         url -- full URL of the poem
+
+        Returns the title on success and None otherwise.
         """
-        if title in self.downloaded_poems:
-            return False
+        fname = title.translate(FS_SAFE_TABLE)
+        if fname in self.downloaded_poems:
+            return None
 
         try:
-            poem = self._fetch_poem(url)
-        except IOError as exc:
+            lines = await self._fetch_poem(session, url)
+        except (aiohttp.ClientError, IOError) as exc:
+            # aiohttp's errors don't subclass IOError the way requests' did,
+            # so both have to be caught for flaky responses.
             if self._verbose:
                 print(f'Could not download {self.poet} - {title}:', exc)
-            return False
+            return None
+
+        poem = self._format_poem(title, lines) if lines else []
+        if not poem:
+            # Don't save (and above all don't mark as downloaded) a poem
+            # that couldn't be extracted--an empty file on disk would
+            # suppress it on every future run.
+            if self._verbose:
+                print(f'No poem found for {self.poet} - {title}')
+            return None
 
         try:
-            self._save_poem(title, self._format_poem(title, poem))
+            self._save_poem(title, poem)
         except IOError as exc:
             # For now (TODO).
             if self._verbose:
                 print(f'Could not save {self.poet} - {title}:', exc)
-            return False
+            return None
 
-        self.downloaded_poems.append(title)
-        return True
+        self.downloaded_poems.add(fname)
+        return title
 
-    def _fetch_poem(self, url):
-        """Downloads and returns each line of the poem as a list of strings."""
+    async def _fetch_poem(self, session, url):
+        """Downloads and returns each line of the poem as a list of strings.
+
+        Returns None if the poem couldn't be fetched. If it is unchanged
+        since the last run, answers with the cached lines instead of
+        downloading the body again.
+        """
         # URL format: https://www.poemhunter.com/poem/poem-title/
-        page = requests.get(url)
-        if page.content:
-            dom = html.fromstring(page.content)
-
-            lines = []
-            p = dom.xpath(
-                    '/html/body/div[1]/div[6]/div[3]/div/div[1]/div[2]/div[1]/p')
-            if p:
-                lines.append(p[0].text)
-                brs = p[0].xpath('br')
-                for br in brs:
-                    if br.tail:
-                        lines.append(br.tail)
-                    else:
-                        lines.append('')
-            return lines
-        else:
-            return ""
+        cached = self._cache.get(url)
+        async with session.get(url, headers=_conditional_headers(cached)) as page:
+            if page.status == 304:
+                return cached['lines']
+            if page.status != 200:
+                # Don't parse (or worse, cache) an error page as a poem.
+                return None
+            dom = await self._parse_page(page)
+            validators = _validators(page)
+        if dom is None:
+            return None
+
+        lines = []
+        p = POEM_BODY_XP(dom)
+        if p:
+            lines.append(p[0].text)
+            brs = LINE_BREAKS_XP(p[0])
+            for br in brs:
+                if br.tail:
+                    lines.append(br.tail)
+                else:
+                    lines.append('')
+        if validators and lines:
+            self._cache[url] = dict(lines=lines, **validators)
+        return lines
+
+    async def _parse_page(self, response):
+        """Parses the response body into a DOM as the chunks arrive.
+
+        Feeding the parser incrementally overlaps parsing with the network
+        wait instead of first buffering the whole body in memory. Returns
+        None if the response body was empty.
+        """
+        # A feed parser can't be shared: concurrent fetches interleave their
+        # feed() calls, so each parse gets a fresh (but tuned) instance.
+        parser = html.HTMLParser(**PARSER_OPTS)
+        empty = True
+        async for chunk in response.content.iter_chunked(65536):
+            parser.feed(chunk)
+            empty = False
+        if empty:
+            return None
+        return parser.close()
 
     def _format_poem(self, title, lines):
         """Removes artifacts and appends title and author to the poem."""
-        if lines:
-            # For some reason there are a \r\n chars at the beginning of the
-            # first line and in the last line and at the end of the second last
-            # line line, so trim these.
-            lines[0] = lines[0].lstrip()
-            lines[-1] = lines[-1].strip()
-            if not lines[-1]:
-                del lines[-1]
-                if lines:
-                    lines[-1] = lines[-1].strip()
-
-            # Insert header (title), footer (poet) and blanks in between.
-            lines.insert(0, title)
-            lines.insert(1, '')
-            lines.insert(1, '')
-            lines.append('')
-            lines.append('')
-            lines.append(self.poet)
-        return lines
+        # For some reason there are \r\n chars scattered around the edges of
+        # the poem body; dropping them from every line with one C-level
+        # translate pass handles them uniformly, with no assumptions about
+        # which lines they show up in. An empty <p> can also yield a None
+        # text node, so filter those out.
+        lines = [line.translate(CR_STRIP) for line in lines if line is not None]
+        while lines and not lines[-1].strip():
+            del lines[-1]
+        if not lines:
+            return lines
+        lines[0] = lines[0].lstrip()
+        lines[-1] = lines[-1].rstrip()
+
+        # Wrap the header (title), footer (poet) and blanks in between around
+        # the poem in one go--each insert(0, ...) would shift the whole poem.
+        return [title, '', ''] + lines + ['', '', self.poet]
 
     def _save_poem(self, title, poem):
         """Writes poem to a file."""
-        with open(self.dest + '/' + title, 'w') as f:
-            for line in poem:
-                f.write(line + '\n')
+        path = self.dest + '/' + title.translate(FS_SAFE_TABLE)
+        with open(path, 'w', buffering=1 << 16) as f:
+            f.write('\n'.join(poem))
+            f.write('\n')
+
+
+def _conditional_headers(cached):
+    """Builds conditional GET headers from a cache entry (None if absent)."""
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_mod'):
+            headers['If-Modified-Since'] = cached['last_mod']
+    return headers
+
+
+def _validators(response):
+    """Extracts the cache validators, if any, from a response's headers."""
+    validators = {}
+    etag = response.headers.get('ETag')
+    if etag:
+        validators['etag'] = etag
+    last_mod = response.headers.get('Last-Modified')
+    if last_mod:
+        validators['last_mod'] = last_mod
+    return validators
 
 
 def parse_top_poets(args):
-    # TODO determine the optimal number of threads, because this means
-    # n * args.concurrency, which might be way too much.
-    # That aside, the whole architecture is probably not great--maybe extend the
-    # PoemHunter class to take a list of poets so that only a single executor
-    # instance is employed?
-    # Or use Twisted or python3 async IO.
-    executor = ThreadPoolExecutor(min(args.number, 10))
-    futures = {}
-    url_base = HOST + f'/p/t/l.asp?l=Top500'
-    page_no = 1
-    n_poets = 0
-    while True:
-        page = requests.get(url_base + f'&p={page_no}')
-        if not page.content:
-            break
-
-        dom = html.fromstring(page.content)
-        poets = dom.xpath('/html/body/div/div[6]/div[2]/div/div/ol/li/a[2]')
-        for poet in poets:
-            if poet is None:
-                continue
-            future = executor.submit(
-                    parse_poet,
-                    poet.text, args.dest,
-                    args.concurrency, args.verbose)
-            futures[future] = poet
-            n_poets += 1
-            if n_poets == args.number:
-                return
-
-        next_page = dom.xpath('//*[@class="next"]/a')
-        if not next_page:
-            break
-        page_no += 1
-        
-    for future in as_completed(futures):
-        poet = futures[future]
-        if args.verbose:
-            print(f'All poems downloaded for {poet}')
-        
+    asyncio.run(_parse_top_poets(args))
+
+
+async def _parse_top_poets(args):
+    """Scrapes the top poets through a bounded producer/consumer pipeline.
+
+    A producer walks the Top500 index pages and feeds poet names into a
+    queue from which the worker coroutines scrape, all over one shared
+    session whose connector caps the in-flight requests. Scraping starts as
+    soon as the first name is known, and total concurrency stays bounded no
+    matter how many poets or poems there are.
+    """
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    queue = asyncio.Queue(maxsize=64)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def producer():
+            page_url = (HOST + '/p/t/l.asp?l=Top500&p=%d').__mod__
+            page_no = 1
+            n_poets = 0
+            while n_poets < args.number:
+                async with session.get(page_url(page_no)) as page:
+                    content = await page.read()
+                if not content:
+                    break
+
+                dom = html.fromstring(content, parser=PARSER)
+                for poet in TOP_POETS_XP(dom):
+                    # An anchor without text would blow up PoemHunter's
+                    # required-argument check in the worker.
+                    if poet.text is None:
+                        continue
+                    await queue.put(poet.text)
+                    n_poets += 1
+                    if n_poets == args.number:
+                        break
+
+                if not NEXT_PAGE_XP(dom):
+                    break
+                page_no += 1
+
+        async def worker():
+            while True:
+                poet = await queue.get()
+                try:
+                    poem_hunter = PoemHunter(
+                            poet=poet, dest=args.dest,
+                            concurrency=args.concurrency, verbose=args.verbose)
+                    await poem_hunter.run(session)
+                    if args.verbose:
+                        print(f'All poems downloaded for {poet}')
+                except (aiohttp.ClientError, IOError) as exc:
+                    if args.verbose:
+                        print(f'Could not download poems of {poet}:', exc)
+                finally:
+                    queue.task_done()
+
+        async def produce_and_drain():
+            await producer()
+            await queue.join()
+
+        workers = [asyncio.create_task(worker())
+                   for _ in range(args.concurrency)]
+        # Race the producer+queue against the workers: workers dying with
+        # unexpected errors must neither leave the producer blocked on a
+        # full queue nor join() waiting forever on items nobody would take.
+        pipeline = asyncio.create_task(produce_and_drain())
+        await asyncio.wait(
+                [pipeline, *workers], return_when=asyncio.FIRST_COMPLETED)
+        pipeline.cancel()
+        for worker_task in workers:
+            worker_task.cancel()
+        # Retrieve everyone's results so an unexpected failure is re-raised
+        # instead of silently dropped with the cancellation.
+        for result in await asyncio.gather(
+                pipeline, *workers, return_exceptions=True):
+            if isinstance(result, Exception):
+                raise result
+
 
 def parse_poet(poet, dest, concurrency, verbose):
     poem_hunter = PoemHunter(
             poet=poet, dest=dest,
-            concurrency=args.concurrency, verbose=verbose)
-    poem_hunter.run()
+            concurrency=concurrency, verbose=verbose)
+    asyncio.run(poem_hunter.run())
 
 
 if __name__ == '__main__':